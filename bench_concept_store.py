@@ -0,0 +1,74 @@
+import argparse
+import random
+import tracemalloc
+import pandas as pd
+from concept_store import ConceptStore
+
+##
+## Memory benchmark for the concept/map data held between ValueSet expansion and TSV write.
+##
+## Builds a synthetic expansion of --concepts concepts (about one in --mapped-every mapped to
+## LOINC) and compares the old representation (a dict per concept, a DataFrame and a separate
+## loinc_codes list) with ConceptStore, reporting the traced peak and bytes per concept.
+##
+
+
+def _expansion(n, mapped_every, seed=1):
+    rng = random.Random(seed)
+    contains = []
+    loinc_codes = []
+    for idx in range(n):
+        code = str(100000000000000 + idx * 1000 + 106)
+        display = f"Observable {idx} [{rng.choice(['Mass', 'Moles', 'Presence'])}/volume] in {rng.choice(['Blood', 'Serum', 'Urine'])}"
+        contains.append({'system': 'http://snomed.info/sct', 'code': code, 'display': display})
+        loinc_codes.append(f"{10000 + idx}-{idx % 10}" if idx % mapped_every == 0 else "")
+    return contains, loinc_codes
+
+
+def _dataframe(contains, loinc_codes):
+    concepts = [{'code': c.get('code'), 'display': c.get('display')} for c in contains]
+    obsdata = pd.DataFrame(concepts)
+    codes = list(loinc_codes)
+    obsdata['loinc_code'] = codes
+    return concepts, obsdata, codes
+
+
+def _concept_store(contains, loinc_codes):
+    store = ConceptStore()
+    for c in contains:
+        store.append(c.get('code'), c.get('display'))
+    for idx, loinc_code in enumerate(loinc_codes):
+        store.set_loinc(idx, loinc_code)
+    return store
+
+
+def _traced_peak(build, *args):
+    tracemalloc.start()
+    result = build(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare memory per concept of the DataFrame and ConceptStore map data')
+    parser.add_argument("-n", "--concepts", help="Number of synthetic concepts", type=int, default=200000)
+    parser.add_argument("-m", "--mapped-every", help="One in this many concepts has a LOINC mapping", type=int, default=8)
+    args = parser.parse_args()
+
+    contains, loinc_codes = _expansion(args.concepts, args.mapped_every)
+    n = len(contains)
+
+    # The expansion strings are shared by both versions, so only the containers built from them are traced
+    _, df_peak = _traced_peak(_dataframe, contains, loinc_codes)
+    store, store_peak = _traced_peak(_concept_store, contains, loinc_codes)
+
+    print(f"Concepts: {n} ({store.mapped_count()} mapped)")
+    print(f"DataFrame version:  {df_peak:>12} bytes traced peak ({df_peak / n:.1f} bytes/concept)")
+    print(f"ConceptStore:       {store_peak:>12} bytes traced peak ({store_peak / n:.1f} bytes/concept)")
+    print(f"ConceptStore.nbytes: {store.nbytes():>11} bytes ({store.bytes_per_concept():.1f} bytes/concept, "
+          f"including the display strings)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+import os
+import gzip
+import json
+import hashlib
+import logging
+import transport
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """
+    On-disk cache for the large terminology server responses (CapabilityStatement and ECL expansions).
+
+    Each entry is keyed by a tuple such as (endpoint, edition, version, ECL) and stores the gzipped
+    response body with its validators: ETag, Last-Modified and, for expansions, the expansion
+    identifier and timestamp. fetch() revalidates an entry with a conditional request
+    (If-None-Match / If-Modified-Since), so an unchanged resource costs one 304 instead of a
+    full download.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _paths(self, key):
+        digest = hashlib.sha1(json.dumps(list(key)).encode('utf-8')).hexdigest()
+        base = os.path.join(self.cache_dir, digest)
+        return base + '.meta.json', base + '.body.gz'
+
+    def _load(self, key):
+        meta_path, body_path = self._paths(key)
+        if not (os.path.isfile(meta_path) and os.path.isfile(body_path)):
+            return None
+        with open(meta_path) as f:
+            return json.load(f)
+
+    def _store(self, key, response, expansion_id, expansion_timestamp):
+        meta_path, body_path = self._paths(key)
+        # Write to temporary files and rename them into place, body first, so an interrupted
+        # write leaves the previous entry (or none) rather than validators next to a partial body.
+        # Fast compression: this runs on every fetch of the full expansion
+        with gzip.open(body_path + '.tmp', 'wb', compresslevel=1) as f:
+            f.write(response.content)
+        os.replace(body_path + '.tmp', body_path)
+        meta = {
+            'key': list(key),
+            'url': response.url,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'content_type': response.headers.get('Content-Type'),
+            'expansion_identifier': expansion_id,
+            'expansion_timestamp': expansion_timestamp,
+        }
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump(meta, f, indent=1)
+        os.replace(meta_path + '.tmp', meta_path)
+
+    def fetch(self, key, url, headers):
+        """
+        GET url, revalidating any cached entry for key.
+        
+        While recording or replaying (see transport), no conditional headers are sent, so the
+        archive holds full 200 responses that replay without this cache directory.
+
+        Returns:
+            tuple: (response, data, unchanged). response has status_code, headers and text; data
+            is the parsed JSON body (None unless the status is 200), so callers don't decode a
+            large expansion twice. unchanged is True when the server confirmed the cached copy
+            (304) or returned an expansion with the same identifier and timestamp as the cached
+            one, False when it differs, and None when there was no cached entry to compare with.
+        """
+        entry = self._load(key)
+        request_headers = dict(headers)
+        if entry and transport.mode() is None:
+            if entry.get('etag'):
+                request_headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                request_headers['If-Modified-Since'] = entry['last_modified']
+
+        response = transport.get(url, headers=request_headers)
+
+        if response.status_code == 304 and entry:
+            logger.info(f"Cache revalidated (304 Not Modified): {url}")
+            _, body_path = self._paths(key)
+            try:
+                with gzip.open(body_path, 'rb') as f:
+                    content = f.read()
+            except (OSError, EOFError) as e:
+                # A damaged body can't be reused: download it again and replace the entry
+                logger.warning(f"Cached body unreadable ({str(e)}); fetching again: {url}")
+                response = transport.get(url, headers=headers)
+            else:
+                cached_headers = {'ETag': entry.get('etag'), 'Last-Modified': entry.get('last_modified'),
+                                  'Content-Type': entry.get('content_type')}
+                cached = transport.StoredResponse(url, 200, {k: v for k, v in cached_headers.items() if v}, content)
+                return cached, cached.json(), True
+
+        if response.status_code != 200:
+            return response, None, False
+
+        data = response.json()
+        expansion = data.get('expansion', {})
+        expansion_id = expansion.get('identifier')
+        expansion_timestamp = expansion.get('timestamp')
+        if entry is None:
+            unchanged = None
+        else:
+            unchanged = bool(expansion_id and
+                             entry.get('expansion_identifier') == expansion_id and
+                             entry.get('expansion_timestamp') == expansion_timestamp)
+        self._store(key, response, expansion_id, expansion_timestamp)
+        if unchanged:
+            logger.info(f"Cache entry unchanged (same expansion identifier {expansion_id}): {url}")
+        else:
+            logger.info(f"Cache entry stored: {url}")
+        return response, data, unchanged
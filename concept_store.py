@@ -0,0 +1,72 @@
+import csv
+import sys
+from array import array
+from itertools import chain
+
+
+class ConceptStore:
+    """
+    Compact columnar store for the concept/map data held between ValueSet expansion and TSV write.
+
+    SNOMED CT concept ids are kept in an unsigned 64-bit array, displays and LOINC codes in
+    parallel lists of strings. LOINC codes are interned so the many unmapped concepts share the
+    empty string; displays are nearly all unique, so they are stored as-is. This avoids a dict
+    per concept, a DataFrame copy and a separate loinc_codes list for large (full edition) expansions.
+    """
+    __slots__ = ('codes', 'displays', 'loinc_codes')
+
+    COLUMNS = ('code', 'display', 'loinc_code')
+
+    def __init__(self):
+        self.codes = array('Q')
+        self.displays = []
+        self.loinc_codes = []
+
+    def __len__(self):
+        return len(self.codes)
+
+    def append(self, code, display):
+        """
+        Add a concept from the expansion. The LOINC code starts empty until set_loinc is called.
+        """
+        self.codes.append(int(code))
+        self.displays.append(display or '')
+        self.loinc_codes.append('')
+
+    def set_loinc(self, index, loinc_code):
+        self.loinc_codes[index] = sys.intern(loinc_code or '')
+
+    def concepts(self):
+        """
+        Yield (code, display) pairs in expansion order, with the code as a string.
+        """
+        for code, display in zip(self.codes, self.displays):
+            yield str(code), display
+
+    def mapped_count(self):
+        return sum(1 for loinc_code in self.loinc_codes if loinc_code)
+
+    def write_tsv(self, output_file):
+        """
+        Write the store as a tab separated map file with columns code, display, loinc_code.
+        """
+        with open(output_file, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+            writer.writerow(self.COLUMNS)
+            for code, display, loinc_code in zip(self.codes, self.displays, self.loinc_codes):
+                writer.writerow((code, display, loinc_code))
+
+    def nbytes(self):
+        """
+        Approximate memory held by the store: the column containers plus each distinct string once.
+        """
+        total = sys.getsizeof(self.codes) + sys.getsizeof(self.displays) + sys.getsizeof(self.loinc_codes)
+        seen = set()
+        for value in chain(self.displays, self.loinc_codes):
+            if id(value) not in seen:
+                seen.add(id(value))
+                total += sys.getsizeof(value)
+        return total
+
+    def bytes_per_concept(self):
+        return self.nbytes() / len(self) if len(self) else 0.0
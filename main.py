@@ -5,6 +5,9 @@ from pathlib import Path
 import logging
 from datetime import datetime
 from utils import check_path
+import transport
+import profiling
+from cache import ResponseCache
 from map import run_capability_test, run_terminology_mapper, map_to_rcpa_spia
     
 
@@ -20,7 +23,22 @@ def main():
     parser.add_argument("-t", "--txendpoint", help="Terminology server endpoint", default=defaulttx)   
     parser.add_argument("-e", "--edition", help="SNOMED CT edition id", default=defaultedition)   
     parser.add_argument("-v", "--version", help="SNOMED CT version date (YYYYMMDD)", default=defaultversion)   
+    parser.add_argument("-p", "--pipeline", help="Stream the expansion through concurrent lookups to the map file", action="store_true")
+    parser.add_argument("-w", "--workers", help="Number of lookup threads in pipeline mode, or partitions expanded at once with --partitioned", type=int, default=8)
+    parser.add_argument("-q", "--queue-size", help="Maximum concepts in flight in pipeline mode", type=int, default=1000)
+    parser.add_argument("--partitioned", help="Expand the Observable ECL as concurrent partitions by child of the Observable root", action="store_true")
+    parser.add_argument("-a", "--all-sheets", help="Map every sheet with a LOINC column and keep all sheets (with their formatting) in the output", action="store_true")
+    parser.add_argument("--no-cache", help="Don't cache the CapabilityStatement and ECL expansion", action="store_true")
+    parser.add_argument("--revalidate", help="Rebuild an existing map file only if the ECL expansion changed on the server", action="store_true")
+    parser.add_argument("--profile", help="Sample each phase on all threads and write folded stacks and a hotspot summary to the logs folder", action="store_true")
+    parser.add_argument("--profile-top", help="Number of hotspots per phase in the profile summary", type=int, default=25)
+    parser.add_argument("--profile-interval", help="Profile sampling interval in milliseconds", type=float, default=10)
+    txmode = parser.add_mutually_exclusive_group()
+    txmode.add_argument("--record", help="Record all terminology server exchanges to this archive", metavar="ARCHIVE")
+    txmode.add_argument("--replay", help="Replay terminology server exchanges from this archive (no network)", metavar="ARCHIVE")
     args = parser.parse_args()
+    if args.revalidate and args.no_cache:
+        parser.error("--revalidate needs the cache; it can't be used with --no-cache")
     
     ## Create the data path if it doesn't exist
     check_path(args.rootdir)
@@ -38,6 +56,10 @@ def main():
     out_dir = os.path.join(args.rootdir, "out")
     check_path(out_dir)
     
+    # setup cache folder for CapabilityStatement and expansion responses
+    cache_dir = os.path.join(args.rootdir, "cache")
+    cache = None if args.no_cache else ResponseCache(cache_dir)
+    
     # setup logs folder
     logs_dir = os.path.join(args.rootdir, "logs")
     check_path(logs_dir)
@@ -52,10 +74,19 @@ def main():
         level=logging.INFO
     )
     logger.info('Started mustSupport element extraction')
-    run_capability_test(args.txendpoint)
+    if args.record:
+        transport.configure('record', args.record)
+    elif args.replay:
+        transport.configure('replay', args.replay)
+    if args.profile:
+        profiling.configure(logs_dir, f'profile-{ts}', top_n=args.profile_top, interval=args.profile_interval / 1000)
+    with profiling.phase("capability_test"):
+        run_capability_test(args.txendpoint, cache=cache)
     
     # Run SNOMED to LOINC mapper if the mapfile doesn't exist for this version
-    map_file = run_terminology_mapper(args.txendpoint, args.edition, args.version, outdir)
+    map_file = run_terminology_mapper(args.txendpoint, args.edition, args.version, outdir,
+                                      pipeline=args.pipeline, workers=args.workers, queue_size=args.queue_size,
+                                      cache=cache, revalidate=args.revalidate, partitioned=args.partitioned)
 
     # Check if map file was created successfully
     if map_file is None:
@@ -75,7 +106,7 @@ def main():
         
         for excel_file in excel_files:
             logger.info(f"Processing: {excel_file}")
-            output_file = map_to_rcpa_spia(excel_file, map_file, out_dir)
+            output_file = map_to_rcpa_spia(excel_file, map_file, out_dir, all_sheets=args.all_sheets)
             
             if output_file:
                 logger.info(f"Successfully processed {os.path.basename(excel_file)}")
@@ -1,6 +1,6 @@
 import os
 import re
-import requests
+import transport
 from datetime import datetime
 from os.path import isfile
 import json
@@ -9,20 +9,26 @@ import pandas as pd
 from urllib.parse import quote
 from fhirpathpy import evaluate
 from utils import get_config
+from concept_store import ConceptStore
+import profiling
 import logging
 
 logger = logging.getLogger(__name__)
 
-def run_capability_test(endpoint):
+def run_capability_test(endpoint, cache=None):
     """
        Fetch the capability statement from the endpoint and assert it 
        instantiates http://hl7.org/fhir/CapabilityStatement/terminology-server
+       If a ResponseCache is given, a cached CapabilityStatement is revalidated instead of refetched.
     """
     query = f'{endpoint}/metadata'
     headers = {'Accept': 'application/fhir+json'}
-    response = requests.get(query, headers=headers)
+    if cache is not None:
+        response, data, _ = cache.fetch((endpoint, 'metadata'), query, headers)
+    else:
+        response = transport.get(query, headers=headers)
+        data = response.json() if response.status_code == 200 else None
     if response.status_code == 200:
-        data = response.json()
         server_type = evaluate(data, "instantiates[0]")
         fhir_version = evaluate(data, "fhirVersion")
         if (isinstance(server_type, list) and len(server_type) > 0 and 
@@ -36,7 +42,173 @@ def run_capability_test(endpoint):
         return response.status_code   # I'm most likely offline
 
 
-def run_terminology_mapper(endpoint, sct_edition, sct_version, outdir):
+# ECL expression to get all Non functional / exam Observable entities
+OBSERVABLE_ROOT = "363787002"
+OBSERVABLE_EXCLUSIONS = "(<< 78064003 OR << 246464006 OR << 363788007 )"
+OBSERVABLE_ECL = f"( < {OBSERVABLE_ROOT} ) MINUS ( {OBSERVABLE_EXCLUSIONS} )"
+# Smaller test : 1405 concepts using descendants of 32337-8 Protein [Mass/volume] in Specimen
+# OBSERVABLE_ECL = "<< 177301010000109"
+
+FHIR_HEADERS = {'Accept': 'application/fhir+json'}
+
+
+def _expand_query(endpoint, sct_edition, sct_version, ecl, offset=None, count=None):
+    """
+    Build the ValueSet/$expand URL for an ECL expression against a SNOMED CT edition/version.
+    offset and count page through the expansion when given.
+    """
+    ecl_encoded = quote(ecl, safe='')
+    valueset_url = f"http://snomed.info/sct/{sct_edition}/version/{sct_version}?fhir_vs=ecl/{ecl_encoded}"
+    expand_query = f'{endpoint}/ValueSet/$expand?url={quote(valueset_url, safe="")}'
+    if offset is not None:
+        expand_query += f'&offset={offset}'
+    if count is not None:
+        expand_query += f'&count={count}'
+    return expand_query
+
+
+def _fetch_expansion(endpoint, sct_edition, sct_version, ecl, count=None, cache=None):
+    """
+    Expand an ECL expression, through the ResponseCache if one is given.
+    
+    Returns:
+        tuple: (expansion, unchanged) where expansion is the 'expansion' element, or None if the
+        request failed, and unchanged is as for ResponseCache.fetch (None without a cache).
+    """
+    expand_query = _expand_query(endpoint, sct_edition, sct_version, ecl, count=count)
+    if cache is not None:
+        response, data, unchanged = cache.fetch((endpoint, sct_edition, sct_version, ecl), expand_query, FHIR_HEADERS)
+    else:
+        response = transport.get(expand_query, headers=FHIR_HEADERS)
+        data = response.json() if response.status_code == 200 else None
+        unchanged = None
+    if response.status_code != 200:
+        logger.error(f"Failed to expand ValueSet for ECL {ecl}: {response.status_code}")
+        logger.error(f"Response: {response.text}")
+        return None, None
+    return data.get('expansion', {}), unchanged
+
+
+def _expand_partitioned(endpoint, sct_edition, sct_version, workers, store, cache=None):
+    """
+    Expand OBSERVABLE_ECL as disjoint-by-root partitions instead of one large server-side expansion.
+    
+    The immediate children of the Observable root are expanded first; each child c then becomes
+    the partition '( << c ) MINUS ( <exclusions> )', and the partitions are expanded concurrently.
+    Concepts with several parents appear in more than one partition, so results are merged into
+    store in child order and deduplicated by code as each partition completes. The merged count
+    is checked against the total of the unpartitioned expansion, requested with count=0 (so only
+    the total is returned) on the same executor, alongside the partitions.
+    
+    With a cache, the children and each partition are cached and revalidated separately, so
+    the partitioned mode never needs the full unpartitioned expansion.
+    
+    Returns:
+        tuple: (ok, unchanged). ok is False if any expansion failed or the totals don't match.
+        unchanged is False if the children or any partition changed in the cache (a new child's
+        partition has no entry, but the children have changed), otherwise None if any of them
+        had no cache entry (or there is no cache), otherwise True.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    
+    children, children_unchanged = _fetch_expansion(endpoint, sct_edition, sct_version,
+                                                    f"<! {OBSERVABLE_ROOT}", cache=cache)
+    if children is None:
+        return False, None
+    child_codes = sorted((c.get('code') for c in children.get('contains', [])), key=int)
+    logger.info(f"Partitioning expansion into {len(child_codes)} sub-expressions by children of {OBSERVABLE_ROOT}")
+    
+    partitions = [f"( << {code} ) MINUS ( {OBSERVABLE_EXCLUSIONS} )" for code in child_codes]
+    states = [children_unchanged]
+    seen = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # Consistency check against the unpartitioned expansion, run alongside the partitions
+        total_future = executor.submit(_fetch_expansion, endpoint, sct_edition, sct_version, OBSERVABLE_ECL, count=0)
+        # map() yields in partition order, so each expansion can be released once it is merged
+        expansions = executor.map(
+            lambda ecl: _fetch_expansion(endpoint, sct_edition, sct_version, ecl, cache=cache), partitions)
+        for ecl, (expansion, unchanged) in zip(partitions, expansions):
+            if expansion is None:
+                return False, None
+            states.append(unchanged)
+            contains = expansion.get('contains', [])
+            logger.info(f"  {ecl}: {len(contains)} concepts")
+            for concept in contains:
+                code = int(concept.get('code'))
+                if code not in seen:
+                    seen.add(code)
+                    store.append(code, concept.get('display'))
+        del seen
+        summary, _ = total_future.result()
+    
+    total = summary.get('total') if summary is not None else None
+    if total is None:
+        logger.warning("Unpartitioned expansion total not available; skipping consistency check")
+    elif total != len(store):
+        logger.error(f"Partitioned expansion returned {len(store)} concepts but the unpartitioned total is {total}")
+        return False, None
+    else:
+        logger.info(f"Partitioned expansion matches unpartitioned total: {total} concepts")
+    
+    if any(state is False for state in states):
+        return True, False
+    if any(state is None for state in states):
+        return True, None
+    return True, True
+
+
+def _extract_loinc(lookup_data):
+    """
+    Return the LOINC code from the equivalentConcept property of a $lookup response, or "" if none.
+    """
+    if 'parameter' in lookup_data:
+        for param in lookup_data['parameter']:
+            if param.get('name') == 'property':
+                parts = param.get('part', [])
+                # Check if this is the equivalentConcept property
+                code_part = None
+                value_part = None
+                
+                for part in parts:
+                    if part.get('name') == 'code' and part.get('valueCode') == 'equivalentConcept':
+                        code_part = part
+                    elif part.get('name') == 'value' and 'valueCoding' in part:
+                        value_part = part
+                
+                if code_part and value_part:
+                    coding = value_part.get('valueCoding', {})
+                    if coding.get('system') == 'http://loinc.org':
+                        return coding.get('code', '')
+    return ""
+
+
+def _lookup_loinc(endpoint, sct_edition, sct_version, code):
+    """
+    Lookup the properties of a SNOMED CT concept and return its equivalent LOINC code.
+    Failures are logged and treated as "no mapping" so one bad lookup doesn't stop the run,
+    except a request missing from a replay archive, which is raised.
+    """
+    lookup_query = (f'{endpoint}/CodeSystem/$lookup?'
+                   f'version=http://snomed.info/sct/{sct_edition}/version/{sct_version}&'
+                   f'code={code}&'
+                   f'property=*&'
+                   f'system=http://snomed.info/sct')
+    try:
+        lookup_response = transport.get(lookup_query, headers=FHIR_HEADERS)
+        
+        if lookup_response.status_code == 200:
+            return _extract_loinc(lookup_response.json())
+        logger.warning(f"Failed to lookup properties for {code}: {lookup_response.status_code}")
+    except transport.ReplayMissError:
+        # An incomplete replay archive must not produce a map with silently missing LOINC codes
+        raise
+    except Exception as e:
+        logger.error(f"Error looking up {code}: {str(e)}")
+    return ""
+
+
+def run_terminology_mapper(endpoint, sct_edition, sct_version, outdir, pipeline=False,
+                           workers=8, queue_size=1000, cache=None, revalidate=False, partitioned=False):
     """
     Reads a spreadsheet of LOINC codes and outputs a map to SNOMED (using LOINCSNOMED extension)
 
@@ -45,6 +217,20 @@ def run_terminology_mapper(endpoint, sct_edition, sct_version, outdir):
         sct_edition (str): SNOMED CT edition ID.
         sct_version (str): SNOMED CT version date.
         outdir (str): Directory to save the map files.
+        pipeline (bool): Stream expansion pages through concurrent lookups to the map file
+            instead of running each step to completion (see _run_pipelined_mapper).
+        workers (int): Number of lookup threads in pipeline mode, or concurrent partition
+            expansions in partitioned mode.
+        queue_size (int): Bound on concepts in flight between the pipeline stages.
+        cache (ResponseCache): Optional cache for the ECL expansion, keyed by endpoint, edition,
+            version and ECL, and revalidated with conditional requests.
+        revalidate (bool): If the map file exists, revalidate the cached expansion against the
+            server and only rebuild the map if it changed. Requires cache. An existing map with
+            no cache entry is kept and the entry is created. A rebuild reuses the expansion
+            downloaded for revalidation, in every mode.
+        partitioned (bool): Expand the Observable ECL as concurrent partitions by the children of
+            the Observable root (see _expand_partitioned). Partitions are cached and revalidated
+            individually. Not used in pipeline mode, which already pages through the expansion.
 
     Returns:
         str: Path to the map file, or None if an error occurred.
@@ -55,119 +241,470 @@ def run_terminology_mapper(endpoint, sct_edition, sct_version, outdir):
     logger.info(f"Starting terminology mapping against: {endpoint}")
     output_file = os.path.join(outdir, f'snomed-loinc-map-{sct_version}.tsv')
     
+    ecl = OBSERVABLE_ECL
+    expand_query = _expand_query(endpoint, sct_edition, sct_version, ecl)
+    cache_key = (endpoint, sct_edition, sct_version, ecl)
+    expansion_data = None
+    store = None
+    
     # Step 0: Check if a map exists for this sct version; if it exists, skip recreating that file
     if os.path.isfile(output_file):
         logger.info(f"Map file already exists for version {sct_version}: {output_file}")
-        logger.info("Skipping map generation. Delete the file to regenerate.")
-        return output_file
+        if revalidate and cache is None:
+            logger.warning("Revalidation needs a cache; ignoring revalidate")
+        if cache is None or not revalidate:
+            logger.info("Skipping map generation. Delete the file to regenerate.")
+            return output_file
+        
+        logger.info("Revalidating cached expansion against the server...")
+        if partitioned and not pipeline:
+            # Revalidate partition by partition; the store is reused if the map needs rebuilding
+            store = ConceptStore()
+            ok, unchanged = _expand_partitioned(endpoint, sct_edition, sct_version, workers, store, cache=cache)
+            if not ok:
+                logger.warning("Could not revalidate partitioned expansion. Keeping existing map file.")
+                return output_file
+        else:
+            response, expansion_data, unchanged = cache.fetch(cache_key, expand_query, FHIR_HEADERS)
+            if response.status_code != 200:
+                logger.warning(f"Could not revalidate expansion ({response.status_code}). Keeping existing map file.")
+                return output_file
+        if unchanged is None:
+            # The map predates the cache (or was built without it): record the validators
+            # for next time rather than rebuilding a map that is probably current
+            logger.info("No cached expansion to compare with. Stored its validators and kept the existing map file.")
+            return output_file
+        if unchanged:
+            logger.info("Expansion unchanged on server. Skipping map generation.")
+            return output_file
+        
+        # Remove the stale map first so a failed rebuild is retried on the next run
+        logger.info("Expansion changed on server. Regenerating map file.")
+        os.remove(output_file)
+
+    if pipeline:
+        if partitioned:
+            logger.warning("Partitioned expansion is not used in pipeline mode; paging through the full expansion")
+        concepts = None
+        if expansion_data is not None:
+            # Reuse the expansion downloaded for revalidation instead of paging through it again
+            concepts = ((c.get('code'), c.get('display')) for c in expansion_data.get('expansion', {}).get('contains', []))
+        with profiling.phase("pipeline"):
+            return _run_pipelined_mapper(endpoint, sct_edition, sct_version, output_file, workers, queue_size,
+                                         concepts=concepts)
 
     # Step 1: Get observables dataframe from SNOMED CT ECL
     logger.info("Step 1: Fetching Observable entities from SNOMED CT using ECL")
     
-    # ECL expression to get all Non functional / exam Observable entities
-    ecl = "( < 363787002 ) MINUS ( (<< 78064003 OR << 246464006 OR << 363788007 ) )"
-    # Smaller test : 1405 concepts using descendants of 32337-8 Protein [Mass/volume] in Specimen
-    # ecl = "<< 177301010000109"
-    ecl_encoded = quote(ecl, safe='')
-    valueset_url = f"http://snomed.info/sct/{sct_edition}/version/{sct_version}?fhir_vs=ecl/{ecl_encoded}"
+    with profiling.phase("expansion"):
+        if store is not None:
+            logger.info("Using the partitioned expansion downloaded for revalidation")
+        elif partitioned:
+            logger.info(f"Expanding ValueSet with partitioned ECL: {ecl}")
+            store = ConceptStore()
+            ok, _ = _expand_partitioned(endpoint, sct_edition, sct_version, workers, store, cache=cache)
+            if not ok:
+                return None
+        else:
+            store = ConceptStore()
+            if expansion_data is None:
+                logger.info(f"Expanding ValueSet with ECL: {ecl}")
+                if cache is not None:
+                    response, expansion_data, _ = cache.fetch(cache_key, expand_query, FHIR_HEADERS)
+                else:
+                    response = transport.get(expand_query, headers=FHIR_HEADERS)
+                    if response.status_code == 200:
+                        expansion_data = response.json()
+                
+                if response.status_code != 200:
+                    logger.error(f"Failed to expand ValueSet: {response.status_code}")
+                    logger.error(f"Response: {response.text}")
+                    return None
+                del response
+            
+            # Extract concepts from expansion into the compact columnar store
+            if 'expansion' in expansion_data and 'contains' in expansion_data['expansion']:
+                for concept in expansion_data['expansion']['contains']:
+                    store.append(concept.get('code'), concept.get('display'))
+            # Release the parsed expansion; the store holds everything needed from here on
+            expansion_data = None
     
-    expand_query = f'{endpoint}/ValueSet/$expand?url={quote(valueset_url, safe="")}'
-    headers = {'Accept': 'application/fhir+json'}
+    logger.info(f"Found {len(store)} Observable entity concepts")
     
-    logger.info(f"Expanding ValueSet with ECL: {ecl}")
-    response = requests.get(expand_query, headers=headers)
+    # Step 2: Iterate through concepts and lookup properties to find LOINC mappings
+    logger.info("Step 2: Looking up properties for each concept to find LOINC mappings")
     
-    if response.status_code != 200:
-        logger.error(f"Failed to expand ValueSet: {response.status_code}")
-        logger.error(f"Response: {response.text}")
-        return None
+    with profiling.phase("lookups"):
+        for idx, (code, display) in enumerate(store.concepts()):
+            logger.info(f"Looking up properties for {code} - {display} ({idx + 1}/{len(store)})")
+            store.set_loinc(idx, _lookup_loinc(endpoint, sct_edition, sct_version, code))
     
-    expansion_data = response.json()
+    # Step 3: Output to TSV file
+    logger.info("Step 3: Writing results to TSV file")
     
-    # Extract concepts from expansion
-    concepts = []
-    if 'expansion' in expansion_data and 'contains' in expansion_data['expansion']:
-        for concept in expansion_data['expansion']['contains']:
-            concepts.append({
-                'code': concept.get('code'),
-                'display': concept.get('display')
-            })
+    with profiling.phase("write_map"):
+        store.write_tsv(output_file)
     
-    logger.info(f"Found {len(concepts)} Observable entity concepts")
+    logger.info(f"Map file created: {output_file}")
+    logger.info(f"Total concepts: {len(store)}")
+    logger.info(f"Concepts with LOINC mapping: {store.mapped_count()}")
+    logger.info(f"Concept store memory: {store.nbytes()} bytes ({store.bytes_per_concept():.1f} bytes/concept)")
     
-    # Create pandas dataframe
-    obsdata = pd.DataFrame(concepts)
+    return output_file
+
+
+def _run_pipelined_mapper(endpoint, sct_edition, sct_version, output_file, workers, queue_size, concepts=None):
+    """
+    Producer/consumer version of run_terminology_mapper.
     
-    # Step 2: Iterate through concepts and lookup properties to find LOINC mappings
-    logger.info("Step 2: Looking up properties for each concept to find LOINC mappings")
+    An expansion reader thread pages through the ECL expansion (offset/count) and feeds concepts
+    into a bounded queue, a pool of lookup threads resolves each concept's LOINC code, and the
+    calling thread writes rows to the map file as they resolve. Rows are written in expansion
+    order using a small reorder buffer, so the output is the same as the sequential mode.
+    A semaphore caps the number of concepts between the reader and the writer at queue_size,
+    which keeps memory bounded regardless of the expansion size.
     
-    loinc_codes = []
+    If concepts is given (an iterable of (code, display), e.g. an expansion already downloaded
+    for revalidation), the reader feeds those instead of paging through the server again.
     
-    for count, (idx, row) in enumerate(obsdata.iterrows(), start=1):
-        code = row['code']
-        display = row['display']
-        
-        # Lookup properties for this concept
-        lookup_query = (f'{endpoint}/CodeSystem/$lookup?'
-                       f'version=http://snomed.info/sct/{sct_edition}/version/{sct_version}&'
-                       f'code={code}&'
-                       f'property=*&'
-                       f'system=http://snomed.info/sct')
+    The map is written to '<output_file>.part' and renamed on success, so an interrupted run
+    is not mistaken for a complete map by the Step 0 check. The reader pages until the reported
+    total is reached (servers may cap count, so a short page is only the end when there is no
+    total); an expansion that ends early fails the run. On any failure the other threads are
+    woken and drained so they exit before the error is returned.
+    """
+    import csv
+    import queue
+    import threading
+    
+    done = object()
+    in_flight = threading.Semaphore(queue_size)
+    stop = threading.Event()
+    concept_queue = queue.Queue(maxsize=queue_size)
+    result_queue = queue.Queue(maxsize=queue_size)
+    reader_error = []
+    
+    def reader():
+        idx = 0
         
-        logger.info(f"Looking up properties for {code} - {display} ({count}/{len(obsdata)})")
+        def emit(code, display):
+            nonlocal idx
+            if stop.is_set():
+                return False
+            in_flight.acquire()
+            if stop.is_set():
+                return False
+            concept_queue.put((idx, code, display or ''))
+            idx += 1
+            return True
         
         try:
-            lookup_response = requests.get(lookup_query, headers=headers)
+            if concepts is not None:
+                logger.info("Pipeline: reading concepts from the downloaded expansion")
+                for code, display in concepts:
+                    if not emit(code, display):
+                        return
+                logger.info(f"Pipeline: expansion reader finished after {idx} concepts")
+                return
             
-            if lookup_response.status_code == 200:
-                lookup_data = lookup_response.json()
-                
-                # Find equivalentConcept property
-                loinc_code = ""
-                if 'parameter' in lookup_data:
-                    for param in lookup_data['parameter']:
-                        if param.get('name') == 'property':
-                            parts = param.get('part', [])
-                            # Check if this is the equivalentConcept property
-                            code_part = None
-                            value_part = None
-                            
-                            for part in parts:
-                                if part.get('name') == 'code' and part.get('valueCode') == 'equivalentConcept':
-                                    code_part = part
-                                elif part.get('name') == 'value' and 'valueCoding' in part:
-                                    value_part = part
-                            
-                            if code_part and value_part:
-                                coding = value_part.get('valueCoding', {})
-                                if coding.get('system') == 'http://loinc.org':
-                                    loinc_code = coding.get('code', '')
-                                    break
-                
-                loinc_codes.append(loinc_code)
-            else:
-                logger.warning(f"Failed to lookup properties for {code}: {lookup_response.status_code}")
-                loinc_codes.append("")
+            ecl = OBSERVABLE_ECL
+            logger.info(f"Pipeline: expanding ValueSet with ECL: {ecl}")
+            previous_first = None
+            total = None
+            while not stop.is_set():
+                expand_query = _expand_query(endpoint, sct_edition, sct_version, ecl, offset=idx, count=queue_size)
+                response = transport.get(expand_query, headers=FHIR_HEADERS)
+                if response.status_code != 200:
+                    logger.error(f"Failed to expand ValueSet: {response.status_code}")
+                    logger.error(f"Response: {response.text}")
+                    reader_error.append(response.status_code)
+                    return
+                expansion = response.json().get('expansion', {})
+                contains = expansion.get('contains', [])
+                if not contains:
+                    break
+                # A page must move forward: if the server ignored offset it sends the previous page again
+                first_code = contains[0].get('code')
+                if idx > 0 and (first_code == previous_first or expansion.get('offset', idx) != idx):
+                    logger.warning(f"Pipeline: server ignored offset={idx}; stopping after {idx} concepts")
+                    break
+                previous_first = first_code
+                for concept in contains:
+                    if not emit(concept.get('code'), concept.get('display')):
+                        return
+                total = expansion.get('total', total)
+                # Stop at the end of the expansion. With a total, page until it is reached: servers
+                # may cap count below queue_size. Without one, a short page is the last, and a page
+                # longer than requested means the server ignored count and sent everything.
+                if total is not None:
+                    if idx >= total:
+                        break
+                elif len(contains) != queue_size:
+                    break
+            if stop.is_set():
+                return
+            if total is not None and idx < total:
+                logger.error(f"Pipeline: expansion ended after {idx} of {total} concepts")
+                reader_error.append(f"expansion ended after {idx} of {total} concepts")
+                return
+            logger.info(f"Pipeline: expansion reader finished after {idx} concepts")
         except Exception as e:
-            logger.error(f"Error looking up {code}: {str(e)}")
-            loinc_codes.append("")
+            logger.error(f"Pipeline: expansion reader failed: {str(e)}")
+            reader_error.append(e)
+        finally:
+            if not stop.is_set():
+                for _ in range(workers):
+                    concept_queue.put(done)
     
-    # Add LOINC codes to dataframe
-    obsdata['loinc_code'] = loinc_codes
+    def lookup_worker():
+        while True:
+            item = concept_queue.get()
+            if item is done:
+                result_queue.put(done)
+                return
+            if stop.is_set():
+                return
+            idx, code, display = item
+            try:
+                loinc_code = _lookup_loinc(endpoint, sct_edition, sct_version, code)
+            except Exception as e:
+                # Hand the error to the writer, which aborts the run
+                result_queue.put(e)
+                return
+            result_queue.put((idx, code, display, loinc_code))
     
-    # Step 3: Output to TSV file
-    logger.info("Step 3: Writing results to TSV file")
+    def drain(q):
+        try:
+            while True:
+                q.get_nowait()
+        except queue.Empty:
+            pass
     
-    obsdata.to_csv(output_file, sep='\t', index=False)
+    def shutdown():
+        # Wake every thread that may be blocked. The reader waits for room (in_flight or a full
+        # concept_queue), so release it and drain its queue until it exits. Then the workers,
+        # which wait for a concept or for room in result_queue: drain their results and send
+        # each one a done marker.
+        stop.set()
+        in_flight.release()
+        reader_thread, worker_threads = threads[0], threads[1:]
+        while reader_thread.is_alive():
+            drain(concept_queue)
+            reader_thread.join(timeout=0.01)
+        while any(t.is_alive() for t in worker_threads):
+            drain(result_queue)
+            for _ in worker_threads:
+                try:
+                    concept_queue.put_nowait(done)
+                except queue.Full:
+                    break
+            for t in worker_threads:
+                t.join(timeout=0.01)
     
+    threads = [threading.Thread(target=reader, name='expansion-reader', daemon=True)]
+    threads += [threading.Thread(target=lookup_worker, name=f'lookup-{n}', daemon=True) for n in range(workers)]
+    for t in threads:
+        t.start()
+    
+    part_file = output_file + '.part'
+    pending = {}
+    next_idx = 0
+    mapped = 0
+    finished_workers = 0
+    try:
+        with open(part_file, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+            writer.writerow(ConceptStore.COLUMNS)
+            while finished_workers < workers:
+                item = result_queue.get()
+                if item is done:
+                    finished_workers += 1
+                    continue
+                if isinstance(item, Exception):
+                    raise item
+                pending[item[0]] = item
+                # Flush every row that is now contiguous with what has been written
+                while next_idx in pending:
+                    _, code, display, loinc_code = pending.pop(next_idx)
+                    writer.writerow((code, display, loinc_code))
+                    in_flight.release()
+                    if loinc_code:
+                        mapped += 1
+                    next_idx += 1
+                    if next_idx % queue_size == 0:
+                        f.flush()
+                        logger.info(f"Pipeline: {next_idx} concepts written to map file")
+    except Exception:
+        shutdown()
+        if os.path.exists(part_file):
+            os.remove(part_file)
+        raise
+    
+    for t in threads:
+        t.join()
+    
+    if reader_error:
+        os.remove(part_file)
+        for error in reader_error:
+            if isinstance(error, transport.ReplayMissError):
+                raise error
+        return None
+    
+    os.replace(part_file, output_file)
     logger.info(f"Map file created: {output_file}")
-    logger.info(f"Total concepts: {len(obsdata)}")
-    logger.info(f"Concepts with LOINC mapping: {obsdata['loinc_code'].astype(bool).sum()}")
+    logger.info(f"Total concepts: {next_idx}")
+    logger.info(f"Concepts with LOINC mapping: {mapped}")
     
     return output_file
 
 
-def map_to_rcpa_spia(spia_file, map_file, outdir):
+def _load_loinc_to_snomed(map_file):
+    """
+    Read the SNOMED-LOINC map TSV and build a lookup from LOINC code to SNOMED CT code and display.
+
+    Args:
+        map_file (str): Path to the SNOMED-LOINC map TSV file.
+
+    Returns:
+        dict: LOINC code -> {'snomed_code', 'snomed_display'}, or None if the map file is invalid.
+    """
+    logger.info("Reading SNOMED-LOINC map file...")
+    map_df = pd.read_csv(map_file, sep='\t')
+    
+    # Verify map file has required columns
+    if 'loinc_code' not in map_df.columns or 'code' not in map_df.columns or 'display' not in map_df.columns:
+        logger.error(f"Error: Map file missing required columns (loinc_code, code, display)")
+        logger.error(f"Available columns: {', '.join(map_df.columns)}")
+        return None
+    
+    logger.info(f"Map file contains {len(map_df)} SNOMED CT concepts")
+    
+    # Create a lookup dictionary from LOINC code to SNOMED CT code and display
+    # Only include entries where loinc_code is not empty
+    loinc_to_snomed = {}
+    for _, row in map_df.iterrows():
+        loinc_code = row['loinc_code']
+        if pd.notna(loinc_code) and loinc_code != '':
+            loinc_to_snomed[str(loinc_code).strip()] = {
+                'snomed_code': row['code'],
+                'snomed_display': row['display']
+            }
+    
+    logger.info(f"Created lookup table with {len(loinc_to_snomed)} LOINC to SNOMED mappings")
+    return loinc_to_snomed
+
+
+def _find_loinc_header(ws, max_header_rows=3):
+    """
+    Locate the 'LOINC' header cell in the first rows of an openpyxl worksheet.
+
+    Returns:
+        tuple: (header_row, column) as 1-based openpyxl indexes, or (None, None) if no LOINC column is found.
+    """
+    for row in ws.iter_rows(min_row=1, max_row=max_header_rows):
+        for cell in row:
+            if str(cell.value).strip().upper() == 'LOINC':
+                return cell.row, cell.column
+    return None, None
+
+
+def _map_workbook(spia_file, loinc_to_snomed, outdir):
+    """
+    Whole-workbook mode for map_to_rcpa_spia.
+    Load the workbook once with openpyxl, add the SNOMED CT columns to each sheet that has a
+    LOINC column in rows 1-3 and leave the other sheets (cover sheets etc.) untouched, then save
+    every sheet to one output workbook. Working on the openpyxl workbook in place keeps cell
+    formatting, merged cells, formulas, column widths and hidden sheets/rows/columns.
+    Content openpyxl itself doesn't round-trip (charts, images, pivot tables) is not kept.
+    
+    Args:
+        spia_file (str): Path to the SPIA Lab results workbook (.xlsx).
+        loinc_to_snomed (dict): Lookup built by _load_loinc_to_snomed.
+        outdir (str): Directory to save the output file.
+    
+    Returns:
+        str: Path to the output file, or None if no sheet contains a LOINC column.
+    """
+    import openpyxl
+    from copy import copy
+    
+    label = os.path.basename(spia_file)
+    logger.info("Reading all sheets of SPIA workbook...")
+    with profiling.phase(f"{label}:read"):
+        wb = openpyxl.load_workbook(spia_file)
+    logger.info(f"Excel file contains sheets: {', '.join(wb.sheetnames)}")
+    
+    total_mapped = 0
+    total_rows = 0
+    mapped_sheets = 0
+    
+    with profiling.phase(f"{label}:join"):
+        for ws in wb.worksheets:
+            header_row, loinc_col = _find_loinc_header(ws)
+            
+            if header_row is None:
+                logger.info(f"  Sheet '{ws.title}': no LOINC column, passing through ({ws.max_row} rows)")
+                continue
+            
+            # Add the SNOMED CT columns after the last used column, styled like the LOINC header
+            code_col = ws.max_column + 1
+            display_col = code_col + 1
+            loinc_header = ws.cell(row=header_row, column=loinc_col)
+            for col, title in ((code_col, 'SNOMED_CT_Code'), (display_col, 'SNOMED_CT_Display')):
+                header_cell = ws.cell(row=header_row, column=col, value=title)
+                if loinc_header.has_style:
+                    header_cell._style = copy(loinc_header._style)
+            
+            mapped_count = 0
+            data_rows = 0
+            for row in ws.iter_rows(min_row=header_row + 1, max_col=code_col - 1):
+                # Formatted but empty rows below the data are part of max_row; don't count them
+                if all(cell.value is None for cell in row):
+                    continue
+                data_rows += 1
+                value = row[loinc_col - 1].value
+                if value is None:
+                    continue
+                entry = loinc_to_snomed.get(str(value).strip())
+                if entry:
+                    mapped_count += 1
+                    ws.cell(row=row[0].row, column=code_col, value=entry['snomed_code'])
+                    ws.cell(row=row[0].row, column=display_col, value=entry['snomed_display'])
+            
+            logger.info(f"  Sheet '{ws.title}': LOINC column in row {header_row}, "
+                        f"mapped {mapped_count} out of {data_rows} rows")
+            total_mapped += mapped_count
+            total_rows += data_rows
+            mapped_sheets += 1
+    
+    if mapped_sheets == 0:
+        logger.error(f"Error: No sheet in {os.path.basename(spia_file)} contains a 'LOINC' column in rows 1-3")
+        return None
+    
+    # Generate output filename
+    now = datetime.now()
+    ts = now.strftime("%Y%m%d-%H%M%S")
+    base_name = os.path.splitext(os.path.basename(spia_file))[0]
+    output_file = os.path.join(outdir, f'{base_name}-snomed-mapped-{ts}.xlsx')
+    
+    logger.info(f"Writing output file: {output_file}")
+    with profiling.phase(f"{label}:write"):
+        wb.save(output_file)
+    
+    # Log summary
+    logger.info("=" * 80)
+    logger.info(f"MAPPING SUMMARY")
+    logger.info(f"File: {os.path.basename(spia_file)}")
+    logger.info(f"SHEETS: {len(wb.worksheets)} ({mapped_sheets} mapped)")
+    logger.info(f"MAPPED: {total_mapped}")
+    logger.info(f"UNMAPPED: {total_rows - total_mapped}")
+    logger.info(f"TOTAL: {total_rows}")
+    logger.info("=" * 80)
+    
+    return output_file
+
+
+def map_to_rcpa_spia(spia_file, map_file, outdir, all_sheets=False):
     """
     This function imports a SPIA Lab results spreadsheet and adds a SNOMED CT column to the end.
     Use the map_file column labeled "loinc_code" to lookup the equivalent SNOMED CT concept 
@@ -179,6 +716,8 @@ def map_to_rcpa_spia(spia_file, map_file, outdir):
         spia_file (str): Path to the SPIA Lab results spreadsheet.
         map_file (str): Path to the SNOMED-LOINC map TSV file.
         outdir (str): Directory to save the output file.
+        all_sheets (bool): Map every sheet with a LOINC column (.xlsx only) and keep all
+            other sheets in the output, instead of only the first sheet with a LOINC column.
     
     Returns:
         str: Path to the output file, or None if an error occurred.
@@ -195,120 +734,112 @@ def map_to_rcpa_spia(spia_file, map_file, outdir):
     logger.info(f"Map file: {map_file}")
     
     try:
-        # Read the SPIA spreadsheet
-        logger.info("Reading SPIA spreadsheet...")
-        
         # Determine file type and read accordingly
         file_extension = os.path.splitext(spia_file)[1].lower()
+        label = os.path.basename(spia_file)
+        
+        if all_sheets and file_extension == '.xlsx':
+            loinc_to_snomed = _load_loinc_to_snomed(map_file)
+            if loinc_to_snomed is None:
+                return None
+            return _map_workbook(spia_file, loinc_to_snomed, outdir)
+        elif all_sheets:
+            logger.warning(f"Whole-workbook mode only supports .xlsx files. Mapping {file_extension} file as a single sheet")
+        
+        # Read the SPIA spreadsheet
+        logger.info("Reading SPIA spreadsheet...")
         
         # For Excel files, first check which sheets are available
-        if file_extension in ['.xlsx', '.xls']:
-            import openpyxl
-            xl_file = pd.ExcelFile(spia_file, engine='openpyxl' if file_extension == '.xlsx' else None)
-            logger.info(f"Excel file contains sheets: {', '.join(str(s) for s in xl_file.sheet_names)}")
+        with profiling.phase(f"{label}:detect"):
+            if file_extension in ['.xlsx', '.xls']:
+                import openpyxl
+                xl_file = pd.ExcelFile(spia_file, engine='openpyxl' if file_extension == '.xlsx' else None)
+                logger.info(f"Excel file contains sheets: {', '.join(str(s) for s in xl_file.sheet_names)}")
             
-            # Try to find the sheet with data (usually not the first if there's a cover sheet)
-            sheet_to_use = None
-            for sheet_name in xl_file.sheet_names:
-                logger.info(f"Checking sheet: {sheet_name}")
-                temp_df = pd.read_excel(spia_file, sheet_name=sheet_name, engine='openpyxl' if file_extension == '.xlsx' else None, nrows=5)
-                logger.info(f"  First few columns: {', '.join(str(c) for c in temp_df.columns[:5])}")
+                # Try to find the sheet with data (usually not the first if there's a cover sheet)
+                sheet_to_use = None
+                for sheet_name in xl_file.sheet_names:
+                    logger.info(f"Checking sheet: {sheet_name}")
+                    temp_df = pd.read_excel(spia_file, sheet_name=sheet_name, engine='openpyxl' if file_extension == '.xlsx' else None, nrows=5)
+                    logger.info(f"  First few columns: {', '.join(str(c) for c in temp_df.columns[:5])}")
                 
-                # Check if this sheet has a LOINC column in first 2 rows
-                for col in temp_df.columns:
-                    if str(col).strip().upper() == 'LOINC':
-                        sheet_to_use = sheet_name
-                        logger.info(f"  Found LOINC column in sheet: {sheet_name}")
-                        break
+                    # Check if this sheet has a LOINC column in first 2 rows
+                    for col in temp_df.columns:
+                        if str(col).strip().upper() == 'LOINC':
+                            sheet_to_use = sheet_name
+                            logger.info(f"  Found LOINC column in sheet: {sheet_name}")
+                            break
                 
-                if sheet_to_use:
-                    break
+                    if sheet_to_use:
+                        break
             
-            if not sheet_to_use:
-                # Default to first sheet and try different header rows
-                sheet_to_use = xl_file.sheet_names[0]
-                logger.warning(f"LOINC column not found in default position. Using sheet: {sheet_to_use}")
+                if not sheet_to_use:
+                    # Default to first sheet and try different header rows
+                    sheet_to_use = xl_file.sheet_names[0]
+                    logger.warning(f"LOINC column not found in default position. Using sheet: {sheet_to_use}")
         
         # Try reading with different header rows (0, 1, 2)
-        loinc_column_name = None
-        for header_row in [0, 1, 2]:
-            if file_extension in ['.xlsx', '.xls']:
-                spia_df = pd.read_excel(spia_file, sheet_name=sheet_to_use, engine='openpyxl' if file_extension == '.xlsx' else None, header=header_row)
-            elif file_extension == '.tsv':
-                spia_df = pd.read_csv(spia_file, sep='\t', header=header_row)
-            elif file_extension == '.csv':
-                spia_df = pd.read_csv(spia_file, header=header_row)
-            else:
-                logger.error(f"Unsupported file format: {file_extension}")
-                return None
+        with profiling.phase(f"{label}:read"):
+            loinc_column_name = None
+            for header_row in [0, 1, 2]:
+                if file_extension in ['.xlsx', '.xls']:
+                    spia_df = pd.read_excel(spia_file, sheet_name=sheet_to_use, engine='openpyxl' if file_extension == '.xlsx' else None, header=header_row)
+                elif file_extension == '.tsv':
+                    spia_df = pd.read_csv(spia_file, sep='\t', header=header_row)
+                elif file_extension == '.csv':
+                    spia_df = pd.read_csv(spia_file, header=header_row)
+                else:
+                    logger.error(f"Unsupported file format: {file_extension}")
+                    return None
             
-            logger.info(f"Trying header row {header_row + 1}. Columns: {', '.join(str(c) for c in spia_df.columns[:10])}")
+                logger.info(f"Trying header row {header_row + 1}. Columns: {', '.join(str(c) for c in spia_df.columns[:10])}")
             
-            # Check if LOINC column exists (case-insensitive search)
-            for col in spia_df.columns:
-                if str(col).strip().upper() == 'LOINC':
-                    loinc_column_name = col
-                    logger.info(f"Found '{col}' column in row {header_row + 1}")
-                    break
+                # Check if LOINC column exists (case-insensitive search)
+                for col in spia_df.columns:
+                    if str(col).strip().upper() == 'LOINC':
+                        loinc_column_name = col
+                        logger.info(f"Found '{col}' column in row {header_row + 1}")
+                        break
             
-            if loinc_column_name:
-                break
-            elif header_row < 2:
-                logger.warning(f"'LOINC' column not found in row {header_row + 1}. Trying row {header_row + 2} as header...")
-        else:
-            # Loop completed without finding LOINC column
-            logger.error(f"Error: SPIA file does not contain a 'LOINC' column in rows 1-3")
-            logger.error(f"Last attempt columns: {', '.join(str(c) for c in spia_df.columns)}")
-            return None
+                if loinc_column_name:
+                    break
+                elif header_row < 2:
+                    logger.warning(f"'LOINC' column not found in row {header_row + 1}. Trying row {header_row + 2} as header...")
+            else:
+                # Loop completed without finding LOINC column
+                logger.error(f"Error: SPIA file does not contain a 'LOINC' column in rows 1-3")
+                logger.error(f"Last attempt columns: {', '.join(str(c) for c in spia_df.columns)}")
+                return None
         
         logger.info(f"Found {len(spia_df)} rows in SPIA file")
         
-        # Read the map file
-        logger.info("Reading SNOMED-LOINC map file...")
-        map_df = pd.read_csv(map_file, sep='\t')
-        
-        # Verify map file has required columns
-        if 'loinc_code' not in map_df.columns or 'code' not in map_df.columns or 'display' not in map_df.columns:
-            logger.error(f"Error: Map file missing required columns (loinc_code, code, display)")
-            logger.error(f"Available columns: {', '.join(map_df.columns)}")
-            return None
-        
-        logger.info(f"Map file contains {len(map_df)} SNOMED CT concepts")
-        
-        # Create a lookup dictionary from LOINC code to SNOMED CT code and display
-        # Only include entries where loinc_code is not empty
-        loinc_to_snomed = {}
-        for _, row in map_df.iterrows():
-            loinc_code = row['loinc_code']
-            if pd.notna(loinc_code) and loinc_code != '':
-                loinc_to_snomed[str(loinc_code).strip()] = {
-                    'snomed_code': row['code'],
-                    'snomed_display': row['display']
-                }
-        
-        logger.info(f"Created lookup table with {len(loinc_to_snomed)} LOINC to SNOMED mappings")
+        # Read the map file and build the LOINC to SNOMED CT lookup
+        with profiling.phase(f"{label}:join"):
+            loinc_to_snomed = _load_loinc_to_snomed(map_file)
+            if loinc_to_snomed is None:
+                return None
         
-        # Map LOINC codes to SNOMED CT codes using vectorized operations
-        logger.info("Mapping LOINC codes to SNOMED CT...")
+            # Map LOINC codes to SNOMED CT codes using vectorized operations
+            logger.info("Mapping LOINC codes to SNOMED CT...")
         
-        # Clean and normalize LOINC codes
-        spia_df['_loinc_clean'] = spia_df[loinc_column_name].astype(str).str.strip()
+            # Clean and normalize LOINC codes
+            spia_df['_loinc_clean'] = spia_df[loinc_column_name].astype(str).str.strip()
         
-        # Use map() for vectorized lookup - much faster than iterrows()
-        spia_df['SNOMED_CT_Code'] = spia_df['_loinc_clean'].map(
-            lambda x: loinc_to_snomed.get(x, {}).get('snomed_code', '') if x and x != 'nan' else ''
-        )
-        spia_df['SNOMED_CT_Display'] = spia_df['_loinc_clean'].map(
-            lambda x: loinc_to_snomed.get(x, {}).get('snomed_display', '') if x and x != 'nan' else ''
-        )
+            # Use map() for vectorized lookup - much faster than iterrows()
+            spia_df['SNOMED_CT_Code'] = spia_df['_loinc_clean'].map(
+                lambda x: loinc_to_snomed.get(x, {}).get('snomed_code', '') if x and x != 'nan' else ''
+            )
+            spia_df['SNOMED_CT_Display'] = spia_df['_loinc_clean'].map(
+                lambda x: loinc_to_snomed.get(x, {}).get('snomed_display', '') if x and x != 'nan' else ''
+            )
         
-        # Remove temporary column
-        spia_df.drop(columns=['_loinc_clean'], inplace=True)
+            # Remove temporary column
+            spia_df.drop(columns=['_loinc_clean'], inplace=True)
         
-        # Count mappings
-        mapped_count = (spia_df['SNOMED_CT_Code'] != '').sum()
-        unmapped_count = len(spia_df) - mapped_count
-        logger.info(f"Successfully mapped {mapped_count} out of {len(spia_df)} rows to SNOMED CT")
+            # Count mappings
+            mapped_count = (spia_df['SNOMED_CT_Code'] != '').sum()
+            unmapped_count = len(spia_df) - mapped_count
+            logger.info(f"Successfully mapped {mapped_count} out of {len(spia_df)} rows to SNOMED CT")
         
         # Generate output filename
         now = datetime.now()
@@ -318,7 +849,8 @@ def map_to_rcpa_spia(spia_file, map_file, outdir):
         
         # Write output file
         logger.info(f"Writing output file: {output_file}")
-        spia_df.to_excel(output_file, index=False)
+        with profiling.phase(f"{label}:write"):
+            spia_df.to_excel(output_file, index=False)
         
         logger.info(f"SPIA mapping completed successfully")
         logger.info(f"Output file: {output_file}")
@@ -0,0 +1,190 @@
+import os
+import re
+import sys
+import time
+import atexit
+import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+##
+## Per-phase sampling profiler for the mapping pipeline.
+##
+## Code marks its phases with `with profiling.phase("name"):`. This is a no-op unless
+## configure() has been called (main.py --profile). When enabled, a background thread samples
+## the stack of every thread (sys._current_frames) at a fixed interval and attributes each
+## sample to the innermost active phase. Sampling covers the pipeline lookup threads and the
+## partition expansion threads as well as the main thread, and shows where wall time goes:
+## waiting on HTTP (socket reads), decoding JSON, building DataFrames, openpyxl, etc.
+##
+## Only Python frames are sampled: time in C code (socket reads, the json C decoder, sleeps)
+## is counted against the innermost Python function that called it.
+##
+## write_reports() saves one '<prefix>-<phase>.folded' file per phase (collapsed stacks,
+## 'thread;outer;...;leaf count', readable by speedscope or flamegraph.pl) and a summary with
+## wall time per phase, the split by thread, the top-N hotspots and the measured sampler overhead.
+##
+
+_phase_stack = []
+_samples = {}
+_wall_times = {}
+_sampler = None
+_stop = threading.Event()
+_lock = threading.Lock()
+_overhead = 0.0
+_sample_count = 0
+_logs_dir = None
+_prefix = None
+_top_n = 25
+_interval = 0.01
+
+
+def configure(logs_dir, prefix, top_n=25, interval=0.01):
+    """
+    Enable profiling, sampling every interval seconds. Reports are written to logs_dir as
+    '<prefix>-<phase>.folded' and '<prefix>-summary.txt' when the program exits.
+    """
+    global _logs_dir, _prefix, _top_n, _interval, _sampler, _overhead, _sample_count
+    _logs_dir = logs_dir
+    _prefix = prefix
+    _top_n = top_n
+    _interval = interval
+    _samples.clear()
+    _wall_times.clear()
+    _overhead = 0.0
+    _sample_count = 0
+    if _sampler is None:
+        _stop.clear()
+        _sampler = threading.Thread(target=_sample_loop, name='profiling-sampler', daemon=True)
+        _sampler.start()
+        atexit.register(write_reports)
+    logger.info(f"Profiling enabled ({interval * 1000:.0f} ms sampling). Reports will be written to: {logs_dir}")
+
+
+@contextmanager
+def phase(name):
+    """
+    Attribute the samples taken while the enclosed block runs, on any thread, to phase 'name'.
+    Nested phases take the samples from their enclosing phase while they run.
+    """
+    if _logs_dir is None:
+        yield
+        return
+
+    with _lock:
+        _phase_stack.append(name)
+        _samples.setdefault(name, Counter())
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with _lock:
+            _phase_stack.remove(name)
+            _wall_times[name] = _wall_times.get(name, 0.0) + elapsed
+
+
+def _thread_group(name):
+    # lookup-3 -> lookup, ThreadPoolExecutor-0_1 -> ThreadPoolExecutor-0
+    return re.sub(r'[-_]\d+$', '', name)
+
+
+def _frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _sample_loop():
+    global _overhead, _sample_count
+    sampler_ident = threading.get_ident()
+    while not _stop.wait(_interval):
+        if not _phase_stack:
+            continue
+        start = time.perf_counter()
+        names = {t.ident: _thread_group(t.name) for t in threading.enumerate()}
+        stacks = []
+        for ident, frame in sys._current_frames().items():
+            if ident == sampler_ident:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(_frame_label(frame.f_code))
+                frame = frame.f_back
+            labels.append(names.get(ident, 'thread'))
+            stacks.append(tuple(reversed(labels)))
+        with _lock:
+            if _phase_stack:
+                counter = _samples[_phase_stack[-1]]
+                for stack in stacks:
+                    counter[stack] += 1
+                _sample_count += 1
+            _overhead += time.perf_counter() - start
+
+
+def _safe_name(name):
+    return re.sub(r'[^A-Za-z0-9._-]+', '_', name)
+
+
+def _write_phase_summary(summary, name, counter):
+    total = sum(counter.values())
+    summary.write("\n" + "=" * 80 + "\n")
+    summary.write(f"PHASE: {name} ({_wall_times.get(name, 0.0):.3f}s wall, {total} thread samples)\n")
+    summary.write("=" * 80 + "\n")
+    if not total:
+        summary.write("(no samples; phase shorter than the sampling interval)\n")
+        return
+
+    threads = Counter()
+    own = Counter()
+    inclusive = Counter()
+    for stack, count in counter.items():
+        threads[stack[0]] += count
+        own[stack[-1]] += count
+        for label in set(stack[1:]):
+            inclusive[label] += count
+
+    summary.write("\nSamples by thread:\n")
+    for thread_name, count in threads.most_common():
+        summary.write(f"  {100.0 * count / total:6.1f}%  {thread_name}\n")
+    summary.write(f"\nTop {_top_n} by own samples (where the threads actually were):\n")
+    for label, count in own.most_common(_top_n):
+        summary.write(f"  {100.0 * count / total:6.1f}%  {label}\n")
+    summary.write(f"\nTop {_top_n} by inclusive samples (function or its callees on the stack):\n")
+    for label, count in inclusive.most_common(_top_n):
+        summary.write(f"  {100.0 * count / total:6.1f}%  {label}\n")
+
+
+def write_reports():
+    """
+    Stop sampling, write the per-phase folded stack files and the hotspot summary, and disable
+    profiling. Returns the summary path, or None if profiling is not enabled.
+    """
+    global _sampler, _logs_dir
+    if _logs_dir is None:
+        return None
+    if _sampler is not None:
+        _stop.set()
+        _sampler.join()
+        _sampler = None
+
+    profiled = sum(_wall_times.values())
+    summary_file = os.path.join(_logs_dir, f'{_prefix}-summary.txt')
+    with open(summary_file, 'w', encoding='utf-8') as summary:
+        summary.write("PHASE WALL TIMES\n")
+        for name, seconds in sorted(_wall_times.items(), key=lambda item: item[1], reverse=True):
+            summary.write(f"{seconds:10.3f}s  {name}\n")
+        summary.write(f"\nSampler: {_sample_count} samples every {_interval * 1000:.0f} ms, "
+                      f"{_overhead:.3f}s spent sampling "
+                      f"({100.0 * _overhead / profiled if profiled else 0.0:.2f}% of profiled wall time)\n")
+
+        for name, counter in _samples.items():
+            with open(os.path.join(_logs_dir, f'{_prefix}-{_safe_name(name)}.folded'), 'w', encoding='utf-8') as f:
+                for stack, count in counter.most_common():
+                    f.write(f"{';'.join(stack)} {count}\n")
+            _write_phase_summary(summary, name, counter)
+
+    _logs_dir = None
+    logger.info(f"Profile summary written to: {summary_file}")
+    return summary_file
@@ -0,0 +1,162 @@
+import os
+import gzip
+import json
+import logging
+import requests
+import transport
+from cache import ResponseCache
+from map import run_capability_test, run_terminology_mapper
+from test_replay import ENDPOINT, SCT_EDITION, SCT_VERSION, _server_response, _no_network
+
+# Setup logging
+logging.basicConfig(
+    format='%(asctime)s %(levelname)s: %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+ETAG = 'W/"1"'
+
+
+class ConditionalServer:
+    """
+    Simulated terminology server that sends an ETag and answers If-None-Match with 304.
+    Keeps the request headers it received so tests can check what was sent.
+    """
+    def __init__(self):
+        self.requests = []
+
+    def get(self, url, headers=None):
+        self.requests.append((url, dict(headers or {})))
+        if (headers or {}).get('If-None-Match') == ETAG:
+            response = requests.Response()
+            response.status_code = 304
+            response.url = url
+            response._content = b''
+            return response
+        response = _server_response(url)
+        response.headers['ETag'] = ETAG
+        return response
+
+    def expand_requests(self):
+        return [headers for url, headers in self.requests if '$expand' in url]
+
+
+def test_not_modified_reuses_cached_body(tmp_path, monkeypatch):
+    """
+    A 304 returns the cached body, already parsed, and reports the entry unchanged.
+    """
+    server = ConditionalServer()
+    monkeypatch.setattr(requests, 'get', server.get)
+    transport.configure()
+    cache = ResponseCache(str(tmp_path / 'cache'))
+    url = f'{ENDPOINT}/metadata'
+
+    response, data, unchanged = cache.fetch((ENDPOINT, 'metadata'), url, {})
+    assert response.status_code == 200 and unchanged is None
+
+    response, cached, unchanged = cache.fetch((ENDPOINT, 'metadata'), url, {})
+    assert server.requests[-1][1]['If-None-Match'] == ETAG
+    assert response.status_code == 200 and unchanged is True
+    assert cached == data
+
+
+def test_interrupted_store_keeps_previous_entry(tmp_path, monkeypatch):
+    """
+    A write that fails part way through the body leaves the previous entry usable.
+    """
+    server = ConditionalServer()
+    monkeypatch.setattr(requests, 'get', server.get)
+    transport.configure()
+    cache = ResponseCache(str(tmp_path / 'cache'))
+    key = (ENDPOINT, 'metadata')
+    url = f'{ENDPOINT}/metadata'
+    _, data, _ = cache.fetch(key, url, {})
+
+    def interrupted_write(self, data):
+        raise OSError("No space left on device")
+
+    with monkeypatch.context() as m:
+        m.setattr(gzip.GzipFile, 'write', interrupted_write)
+        try:
+            cache._store(key, _server_response(url), None, None)
+        except OSError:
+            pass
+
+    response, cached, unchanged = cache.fetch(key, url, {})
+    assert unchanged is True and cached == data
+
+
+def test_unreadable_cached_body_is_fetched_again(tmp_path, monkeypatch):
+    """
+    A 304 for an entry whose body can't be read downloads the body again instead of failing.
+    """
+    server = ConditionalServer()
+    monkeypatch.setattr(requests, 'get', server.get)
+    transport.configure()
+    cache = ResponseCache(str(tmp_path / 'cache'))
+    key = (ENDPOINT, 'metadata')
+    url = f'{ENDPOINT}/metadata'
+    _, data, _ = cache.fetch(key, url, {})
+    _, body_path = cache._paths(key)
+    with open(body_path, 'r+b') as f:
+        f.truncate(10)
+
+    response, fetched, _ = cache.fetch(key, url, {})
+    assert response.status_code == 200 and fetched == data
+    assert [h.get('If-None-Match') for _, h in server.requests] == [None, ETAG, None]
+    # The entry was replaced, so the next revalidation uses it again
+    assert cache.fetch(key, url, {})[1] == data
+
+
+def test_revalidate_without_cache_entry_keeps_map(tmp_path, monkeypatch):
+    """
+    --revalidate on a map that predates the cache stores the validators and keeps the map.
+    """
+    server = ConditionalServer()
+    monkeypatch.setattr(requests, 'get', server.get)
+    transport.configure()
+    map_file = tmp_path / f'snomed-loinc-map-{SCT_VERSION}.tsv'
+    map_file.write_text('code\tdisplay\tloinc_code\n')
+    cache = ResponseCache(str(tmp_path / 'cache'))
+
+    for _ in range(2):
+        result = run_terminology_mapper(ENDPOINT, SCT_EDITION, SCT_VERSION, str(tmp_path),
+                                        cache=cache, revalidate=True)
+        assert result == str(map_file)
+        assert map_file.read_text() == 'code\tdisplay\tloinc_code\n'
+    # The second run revalidated with one conditional request and no lookups
+    assert [h.get('If-None-Match') for h in server.expand_requests()] == [None, ETAG]
+    assert not any('$lookup' in url for url, _ in server.requests)
+
+
+def test_recording_with_warm_cache_replays_without_it(tmp_path, monkeypatch):
+    """
+    A run recorded with a warm cache stores full responses, so it replays with an empty cache.
+    """
+    server = ConditionalServer()
+    monkeypatch.setattr(requests, 'get', server.get)
+    transport.configure()
+    warm = ResponseCache(str(tmp_path / 'warm'))
+    (tmp_path / 'first').mkdir()
+    assert run_capability_test(ENDPOINT, cache=warm) == 200
+    run_terminology_mapper(ENDPOINT, SCT_EDITION, SCT_VERSION, str(tmp_path / 'first'), cache=warm)
+
+    archive = str(tmp_path / 'exchanges.zip')
+    (tmp_path / 'recorded').mkdir()
+    transport.configure('record', archive)
+    assert run_capability_test(ENDPOINT, cache=warm) == 200
+    run_terminology_mapper(ENDPOINT, SCT_EDITION, SCT_VERSION, str(tmp_path / 'recorded'), cache=warm)
+    transport.close()
+
+    monkeypatch.setattr(requests, 'get', _no_network)
+    (tmp_path / 'replayed').mkdir()
+    transport.configure('replay', archive)
+    try:
+        cold = ResponseCache(str(tmp_path / 'cold'))
+        assert run_capability_test(ENDPOINT, cache=cold) == 200
+        map_file = run_terminology_mapper(ENDPOINT, SCT_EDITION, SCT_VERSION, str(tmp_path / 'replayed'), cache=cold)
+    finally:
+        transport.configure()
+    with open(map_file) as f:
+        assert f.read().count('\n') == 3
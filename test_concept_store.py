@@ -0,0 +1,66 @@
+import sys
+import logging
+import pandas as pd
+from concept_store import ConceptStore
+
+# Setup logging
+logging.basicConfig(
+    format='%(asctime)s %(levelname)s: %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+CONCEPTS = [
+    {'code': '168331010000106', 'display': 'Hemoglobin [Mass/volume] in Blood'},
+    {'code': '77386006', 'display': 'Pregnancy'},
+    {'code': '167221010000109', 'display': 'Glucose "fasting"\tin Serum, Plasma'},
+    {'code': '363787002', 'display': None},
+]
+LOINC_CODES = ['718-7', '', '2345-7', None]
+
+
+def _store():
+    store = ConceptStore()
+    for concept in CONCEPTS:
+        store.append(concept['code'], concept['display'])
+    for idx, loinc_code in enumerate(LOINC_CODES):
+        store.set_loinc(idx, loinc_code)
+    return store
+
+
+def test_write_tsv_matches_pandas_output(tmp_path):
+    """
+    The map file is byte-for-byte what the DataFrame version wrote, quoting included.
+    """
+    store = _store()
+    store.write_tsv(str(tmp_path / 'store.tsv'))
+
+    obsdata = pd.DataFrame(CONCEPTS)
+    obsdata['loinc_code'] = [loinc_code or '' for loinc_code in LOINC_CODES]
+    obsdata.to_csv(str(tmp_path / 'pandas.tsv'), sep='\t', index=False)
+
+    assert (tmp_path / 'store.tsv').read_bytes() == (tmp_path / 'pandas.tsv').read_bytes()
+
+
+def test_append_and_set_loinc():
+    """
+    Concepts keep expansion order; unmapped concepts share the interned empty string.
+    """
+    store = _store()
+    assert len(store) == 4
+    assert list(store.concepts())[:2] == [('168331010000106', 'Hemoglobin [Mass/volume] in Blood'),
+                                          ('77386006', 'Pregnancy')]
+    assert store.displays[3] == ''
+    assert store.mapped_count() == 2
+    assert store.loinc_codes[1] is store.loinc_codes[3]
+    assert store.loinc_codes[0] is sys.intern('718-7')
+
+
+def test_nbytes_counts_shared_strings_once():
+    store = _store()
+    strings = {id(s): s for s in store.displays + store.loinc_codes}
+    expected = (sys.getsizeof(store.codes) + sys.getsizeof(store.displays) + sys.getsizeof(store.loinc_codes)
+                + sum(sys.getsizeof(s) for s in strings.values()))
+    assert store.nbytes() == expected
+    assert store.bytes_per_concept() == expected / 4
+    assert ConceptStore().bytes_per_concept() == 0.0
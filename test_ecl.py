@@ -1,4 +1,4 @@
-import requests
+import transport
 import logging
 import pandas as pd
 from urllib.parse import quote
@@ -47,7 +47,7 @@ def test_ecl_expansion(endpoint, ecl, sct_edition=None, sct_version=None):
     logger.info("")
     
     try:
-        response = requests.get(expand_query, headers=headers)
+        response = transport.get(expand_query, headers=headers)
         
         if response.status_code == 200:
             expansion_data = response.json()
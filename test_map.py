@@ -1,4 +1,4 @@
-import requests
+import transport
 import logging
 from map import run_capability_test
 
@@ -43,7 +43,7 @@ def test_snomed_to_loinc_mapping(endpoint, sct_edition, sct_version):
                     f'system=http://snomed.info/sct')
     
     try:
-        response1 = requests.get(lookup_query1, headers=headers)
+        response1 = transport.get(lookup_query1, headers=headers)
         
         if response1.status_code == 200:
             lookup_data1 = response1.json()
@@ -108,7 +108,7 @@ def test_snomed_to_loinc_mapping(endpoint, sct_edition, sct_version):
                     f'system=http://snomed.info/sct')
     
     try:
-        response2 = requests.get(lookup_query2, headers=headers)
+        response2 = transport.get(lookup_query2, headers=headers)
         
         if response2.status_code == 200:
             lookup_data2 = response2.json()
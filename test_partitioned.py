@@ -0,0 +1,123 @@
+import json
+import hashlib
+import logging
+import pytest
+import requests
+import transport
+from urllib.parse import parse_qs, unquote, urlsplit
+from cache import ResponseCache
+from concept_store import ConceptStore
+from map import OBSERVABLE_ECL, OBSERVABLE_EXCLUSIONS, OBSERVABLE_ROOT, _expand_partitioned, run_terminology_mapper
+from test_replay import ENDPOINT, SCT_EDITION, SCT_VERSION, _server_response
+
+# Setup logging
+logging.basicConfig(
+    format='%(asctime)s %(levelname)s: %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+
+class PartitionServer:
+    """
+    Simulated terminology server for partitioned expansion. children maps each child of the
+    Observable root to the codes of its partition ('<< child' minus the exclusions); a code
+    listed under several children has several parents. Expansions carry an ETag derived from
+    their content and If-None-Match is answered with 304. total overrides the total of the
+    unpartitioned expansion.
+    """
+    def __init__(self, children, total=None):
+        self.children = children
+        self.total = total
+
+    def _expansion(self, ecl):
+        if ecl == f"<! {OBSERVABLE_ROOT}":
+            codes = list(self.children)
+        elif ecl == OBSERVABLE_ECL:
+            codes = sorted({code for members in self.children.values() for code in members}, key=int)
+        else:
+            child = ecl.split()[2]
+            assert ecl == f"( << {child} ) MINUS ( {OBSERVABLE_EXCLUSIONS} )"
+            codes = self.children[child]
+        return {"total": len(codes), "contains": [{"system": "http://snomed.info/sct", "code": code,
+                                                     "display": f"Observable {code}"} for code in codes]}
+
+    def get(self, url, headers=None):
+        if '/ValueSet/$expand' not in url:
+            return _server_response(url)
+        query = parse_qs(urlsplit(url).query)
+        ecl = unquote(query['url'][0].split('fhir_vs=ecl/', 1)[1])
+        expansion = self._expansion(ecl)
+        if 'count' in query and query['count'][0] == '0':
+            expansion = {"total": self.total if self.total is not None else expansion["total"]}
+        content = json.dumps({"resourceType": "ValueSet", "expansion": expansion}).encode('utf-8')
+        etag = f'W/"{hashlib.sha1(content).hexdigest()}"'
+        response = requests.Response()
+        response.url = url
+        if (headers or {}).get('If-None-Match') == etag:
+            response.status_code = 304
+            response._content = b''
+        else:
+            response.status_code = 200
+            response.headers['ETag'] = etag
+            response._content = content
+        return response
+
+
+@pytest.fixture
+def server(monkeypatch):
+    server = PartitionServer({'1': ['1', '10', '30'], '2': ['2', '10', '20']})
+    monkeypatch.setattr(requests, 'get', server.get)
+    transport.configure()
+    return server
+
+
+def test_concepts_with_several_parents_are_merged_once(server):
+    """
+    Partitions are merged in child order, keeping the first occurrence of each code.
+    """
+    store = ConceptStore()
+    assert _expand_partitioned(ENDPOINT, SCT_EDITION, SCT_VERSION, 2, store) == (True, None)
+    assert [code for code, _ in store.concepts()] == ['1', '10', '30', '2', '20']
+
+
+def test_total_mismatch_fails(server):
+    server.total = 6
+    assert _expand_partitioned(ENDPOINT, SCT_EDITION, SCT_VERSION, 2, ConceptStore())[0] is False
+
+
+def test_revalidation_states(server, tmp_path):
+    """
+    unchanged is None without cache entries, True when every expansion is confirmed unchanged,
+    and False when a partition or the children change, even if a new partition has no entry.
+    """
+    cache = ResponseCache(str(tmp_path / 'cache'))
+
+    def expand():
+        return _expand_partitioned(ENDPOINT, SCT_EDITION, SCT_VERSION, 2, ConceptStore(), cache=cache)
+
+    assert expand() == (True, None)
+    assert expand() == (True, True)
+    server.children['2'] = ['2', '10', '20', '21']
+    assert expand() == (True, False)
+    assert expand() == (True, True)
+    server.children['3'] = ['3']
+    assert expand() == (True, False)
+
+
+def test_revalidate_rebuilds_map_when_a_partition_is_added(server, tmp_path):
+    """
+    A new child of the Observable root makes --revalidate --partitioned rebuild the map.
+    """
+    cache = ResponseCache(str(tmp_path / 'cache'))
+
+    def build():
+        return run_terminology_mapper(ENDPOINT, SCT_EDITION, SCT_VERSION, str(tmp_path), cache=cache,
+                                      revalidate=True, partitioned=True)
+
+    map_file = build()
+    server.children['3'] = ['3', '31']
+    build()
+    with open(map_file) as f:
+        codes = [line.split('\t')[0] for line in f][1:]
+    assert codes == ['1', '10', '30', '2', '20', '3', '31']
@@ -0,0 +1,107 @@
+import json
+import time
+import logging
+import threading
+import pytest
+import requests
+import transport
+from urllib.parse import parse_qs, urlsplit
+from map import run_terminology_mapper
+from test_replay import ENDPOINT, SCT_EDITION, SCT_VERSION, _server_response
+
+# Setup logging
+logging.basicConfig(
+    format='%(asctime)s %(levelname)s: %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+
+class PagingServer:
+    """
+    Simulated terminology server that pages $expand with offset/count, returning at most
+    page_cap concepts per page whatever count asks for. stop_after truncates the expansion
+    while still reporting the full total.
+    """
+    def __init__(self, n, page_cap, stop_after=None):
+        self.codes = [str(100000000000000 + idx * 1000 + 106) for idx in range(n)]
+        self.page_cap = page_cap
+        self.stop_after = stop_after
+        self.pages = 0
+
+    def get(self, url, headers=None):
+        if '/ValueSet/$expand' not in url:
+            return _server_response(url)
+        self.pages += 1
+        query = parse_qs(urlsplit(url).query)
+        offset = int(query['offset'][0])
+        count = min(int(query['count'][0]), self.page_cap)
+        available = self.codes[:self.stop_after] if self.stop_after is not None else self.codes
+        contains = [{"system": "http://snomed.info/sct", "code": code, "display": f"Observable {code}"}
+                    for code in available[offset:offset + count]]
+        response = requests.Response()
+        response.status_code = 200
+        response.url = url
+        response._content = json.dumps({"resourceType": "ValueSet", "expansion": {
+            "total": len(self.codes), "offset": offset, "contains": contains}}).encode('utf-8')
+        return response
+
+
+def _pipeline_threads():
+    return [t for t in threading.enumerate() if t.name == 'expansion-reader' or t.name.startswith('lookup-')]
+
+
+@pytest.fixture(autouse=True)
+def live_transport():
+    transport.configure()
+    yield
+    transport.configure()
+
+
+def test_pages_until_total_when_server_caps_count(tmp_path, monkeypatch):
+    """
+    A server that returns 5 concepts per page when 10 were asked for still yields the whole map.
+    """
+    server = PagingServer(12, page_cap=5)
+    monkeypatch.setattr(requests, 'get', server.get)
+    map_file = run_terminology_mapper(ENDPOINT, SCT_EDITION, SCT_VERSION, str(tmp_path),
+                                      pipeline=True, workers=3, queue_size=10)
+    with open(map_file) as f:
+        rows = [line.rstrip('\n').split('\t') for line in f]
+    assert [row[0] for row in rows[1:]] == server.codes
+    assert server.pages == 3
+
+
+def test_expansion_ending_before_total_fails_run(tmp_path, monkeypatch):
+    """
+    An expansion that stops short of its total does not produce a (truncated) map file.
+    """
+    server = PagingServer(12, page_cap=5, stop_after=7)
+    monkeypatch.setattr(requests, 'get', server.get)
+    result = run_terminology_mapper(ENDPOINT, SCT_EDITION, SCT_VERSION, str(tmp_path),
+                                    pipeline=True, workers=3, queue_size=10)
+    assert result is None
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_failure_stops_pipeline_threads(tmp_path, monkeypatch):
+    """
+    When a lookup fails the run, the reader and the other lookup threads exit promptly, even
+    though they are blocked on full queues or the in-flight limit at the time.
+    """
+    server = PagingServer(200, page_cap=4)
+    failing_code = server.codes[20]
+
+    def get(url, headers=None):
+        if '$lookup' in url and f'code={failing_code}&' in url:
+            raise transport.ReplayMissError(f"No recorded response for: {url}")
+        return server.get(url, headers)
+
+    monkeypatch.setattr(requests, 'get', get)
+    start = time.perf_counter()
+    with pytest.raises(transport.ReplayMissError):
+        run_terminology_mapper(ENDPOINT, SCT_EDITION, SCT_VERSION, str(tmp_path),
+                               pipeline=True, workers=4, queue_size=4)
+    assert _pipeline_threads() == []
+    assert time.perf_counter() - start < 1
+    assert list(tmp_path.iterdir()) == []
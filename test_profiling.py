@@ -0,0 +1,41 @@
+import time
+import logging
+import threading
+import profiling
+
+# Setup logging
+logging.basicConfig(
+    format='%(asctime)s %(levelname)s: %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+
+def busy_lookup_work(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        sum(range(1000))
+
+
+def test_phase_samples_worker_threads(tmp_path):
+    """
+    Samples taken in threads started inside a phase are attributed to that phase and reported.
+    """
+    profiling.configure(str(tmp_path), 'profile-test', top_n=10, interval=0.001)
+    with profiling.phase('lookups'):
+        workers = [threading.Thread(target=busy_lookup_work, args=(0.2,), name=f'lookup-{n}') for n in range(2)]
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+    summary_file = profiling.write_reports()
+
+    with open(summary_file) as f:
+        summary = f.read()
+    assert 'PHASE: lookups' in summary
+    assert 'busy_lookup_work (test_profiling.py:' in summary
+    assert '% of profiled wall time' in summary
+    with open(tmp_path / 'profile-test-lookups.folded') as f:
+        assert any(line.startswith('lookup;') for line in f)
+    # Reports disable profiling, so later phases are no-ops
+    assert profiling.write_reports() is None
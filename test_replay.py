@@ -0,0 +1,128 @@
+import json
+import logging
+import zipfile
+import pytest
+import requests
+import transport
+from urllib.parse import parse_qs, urlsplit
+from map import run_capability_test, run_terminology_mapper
+
+# Setup logging
+logging.basicConfig(
+    format='%(asctime)s %(levelname)s: %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+ENDPOINT = "http://tx.example.org/fhir"
+SCT_EDITION = "11010000107"  # LOINC SNOMED extension
+SCT_VERSION = "20250921"
+
+CAPABILITY = {
+    "resourceType": "CapabilityStatement",
+    "instantiates": ["http://hl7.org/fhir/CapabilityStatement/terminology-server"],
+    "fhirVersion": "4.0.1"
+}
+EXPANSION = {
+    "resourceType": "ValueSet",
+    "expansion": {
+        "total": 2,
+        "contains": [
+            {"system": "http://snomed.info/sct", "code": "168331010000106", "display": "Hemoglobin [Mass/volume] in Blood"},
+            {"system": "http://snomed.info/sct", "code": "77386006", "display": "Pregnancy"}
+        ]
+    }
+}
+LOINC_MAPPINGS = {"168331010000106": "718-7"}
+
+
+def _server_response(url):
+    """
+    Build the response a terminology server would send for the /metadata, $expand and $lookup requests.
+    """
+    if url.endswith('/metadata'):
+        body = CAPABILITY
+    elif '/ValueSet/$expand' in url:
+        body = EXPANSION
+    else:
+        code = parse_qs(urlsplit(url).query)['code'][0]
+        parameters = [{"name": "code", "valueCode": code}]
+        if code in LOINC_MAPPINGS:
+            parameters.append({"name": "property", "part": [
+                {"name": "code", "valueCode": "equivalentConcept"},
+                {"name": "value", "valueCoding": {"system": "http://loinc.org", "code": LOINC_MAPPINGS[code]}}
+            ]})
+        body = {"resourceType": "Parameters", "parameter": parameters}
+    response = requests.Response()
+    response.status_code = 200
+    response.url = url
+    response.headers['Content-Type'] = 'application/fhir+json'
+    response._content = json.dumps(body).encode('utf-8')
+    return response
+
+
+def _no_network(url, headers=None):
+    raise AssertionError(f"Replay made a network request: {url}")
+
+
+@pytest.fixture(params=[False, True], ids=['sequential', 'pipeline'])
+def pipeline(request):
+    return request.param
+
+
+@pytest.fixture
+def archive(tmp_path, monkeypatch, pipeline):
+    """
+    Record a mapper run against the simulated server and return the archive path.
+    """
+    archive_path = str(tmp_path / 'exchanges.zip')
+    (tmp_path / 'recorded').mkdir()
+    monkeypatch.setattr(requests, 'get', lambda url, headers=None: _server_response(url))
+    transport.configure('record', archive_path)
+    assert run_capability_test(ENDPOINT) == 200
+    run_terminology_mapper(ENDPOINT, SCT_EDITION, SCT_VERSION, str(tmp_path / 'recorded'),
+                           pipeline=pipeline, workers=2, queue_size=10)
+    transport.close()
+    monkeypatch.setattr(requests, 'get', _no_network)
+    yield archive_path
+    transport.configure()
+
+
+def test_replay_builds_map_offline(archive, tmp_path, pipeline):
+    """
+    Replaying the archive rebuilds the same map with no network access.
+    """
+    (tmp_path / 'replayed').mkdir()
+    transport.configure('replay', archive)
+    assert run_capability_test(ENDPOINT) == 200
+    map_file = run_terminology_mapper(ENDPOINT, SCT_EDITION, SCT_VERSION, str(tmp_path / 'replayed'),
+                                      pipeline=pipeline, workers=2, queue_size=10)
+    with open(map_file) as f:
+        rows = [line.rstrip('\n').split('\t') for line in f]
+    assert rows == [
+        ['code', 'display', 'loinc_code'],
+        ['168331010000106', 'Hemoglobin [Mass/volume] in Blood', '718-7'],
+        ['77386006', 'Pregnancy', '']
+    ]
+
+
+def test_replay_miss_fails_run(archive, tmp_path, pipeline):
+    """
+    A request missing from the archive aborts the run instead of writing an incomplete map.
+    """
+    # Drop the 77386006 $lookup from the archive
+    incomplete = str(tmp_path / 'incomplete.zip')
+    with zipfile.ZipFile(archive) as src, zipfile.ZipFile(incomplete, 'w') as dst:
+        index = json.loads(src.read(transport.INDEX_NAME))
+        index = {url: entry for url, entry in index.items() if 'code=77386006' not in url}
+        for name in {entry['entry'] for entry in index.values()}:
+            dst.writestr(name, src.read(name))
+        dst.writestr(transport.INDEX_NAME, json.dumps(index))
+
+    outdir = tmp_path / 'replayed'
+    outdir.mkdir()
+    transport.configure('replay', incomplete)
+    with pytest.raises(transport.ReplayMissError):
+        run_terminology_mapper(ENDPOINT, SCT_EDITION, SCT_VERSION, str(outdir),
+                               pipeline=pipeline, workers=2, queue_size=10)
+    assert list(outdir.iterdir()) == []
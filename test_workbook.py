@@ -0,0 +1,98 @@
+import logging
+import openpyxl
+from openpyxl.styles import Font, PatternFill
+from map import map_to_rcpa_spia
+
+# Setup logging
+logging.basicConfig(
+    format='%(asctime)s %(levelname)s: %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+MAP_ROWS = [
+    ('code', 'display', 'loinc_code'),
+    ('168331010000106', 'Hemoglobin [Mass/volume] in Blood', '718-7'),
+    ('167221010000109', 'Glucose [Moles/volume] in Serum or Plasma', '2345-7'),
+    ('77386006', 'Pregnancy', ''),
+]
+HEADER_FONT = Font(bold=True, color='FF0000FF')
+NOTE_FILL = PatternFill('solid', start_color='FFFFFF00')
+
+
+def _write_inputs(tmp_path):
+    """
+    Write a SNOMED-LOINC map and a SPIA-like workbook: a cover sheet, a LOINC sheet with its
+    header in row 1 and one with two title rows above the header (row 3) and formatted empty
+    rows below the data.
+    """
+    map_file = tmp_path / 'map.tsv'
+    map_file.write_text(''.join('\t'.join(row) + '\n' for row in MAP_ROWS))
+
+    wb = openpyxl.Workbook()
+    cover = wb.active
+    cover.title = 'Cover'
+    cover['A1'] = 'RCPA SPIA Chemical Pathology'
+    cover['A1'].font = HEADER_FONT
+    cover['A2'] = 'Version 3.1'
+
+    chem = wb.create_sheet('Chemistry')
+    chem.append(['RCPA Term', 'LOINC', 'Units'])
+    chem.append(['Glucose', '2345-7', 'mmol/L'])
+    chem.append(['Sodium', '2951-2', 'mmol/L'])
+    for cell in chem[1]:
+        cell.font = HEADER_FONT
+    chem['C2'].fill = NOTE_FILL
+
+    haem = wb.create_sheet('Haematology')
+    haem.append(['Haematology terms'])
+    haem.append(['Reviewed 2024'])
+    haem.append(['RCPA Term', 'LOINC'])
+    haem.append(['Haemoglobin', '718-7'])
+    haem.append(['Comment', None])
+    haem['B3'].font = HEADER_FONT
+    # Formatting applied to rows without data extends max_row
+    for row in range(6, 11):
+        haem.cell(row=row, column=1).fill = NOTE_FILL
+
+    spia_file = tmp_path / 'spia.xlsx'
+    wb.save(spia_file)
+    return str(spia_file), str(map_file)
+
+
+def test_all_sheets_keeps_every_sheet_and_its_formatting(tmp_path, caplog):
+    """
+    Whole-workbook mode maps each LOINC sheet in place and passes the cover sheet through.
+    """
+    spia_file, map_file = _write_inputs(tmp_path)
+    outdir = tmp_path / 'out'
+    outdir.mkdir()
+
+    with caplog.at_level(logging.INFO):
+        output_file = map_to_rcpa_spia(spia_file, map_file, str(outdir), all_sheets=True)
+
+    wb = openpyxl.load_workbook(output_file)
+    assert wb.sheetnames == ['Cover', 'Chemistry', 'Haematology']
+
+    cover = wb['Cover']
+    assert cover.max_column == 1
+    assert cover['A1'].value == 'RCPA SPIA Chemical Pathology' and cover['A1'].font.bold
+
+    chem = wb['Chemistry']
+    assert [c.value for c in chem[1]] == ['RCPA Term', 'LOINC', 'Units', 'SNOMED_CT_Code', 'SNOMED_CT_Display']
+    assert [c.value for c in chem[2]][3:] == [167221010000109, 'Glucose [Moles/volume] in Serum or Plasma']
+    assert [c.value for c in chem[3]][3:] == [None, None]
+    assert chem['D1'].font.bold and chem['D1'].font.color.rgb == 'FF0000FF'
+    assert chem['C2'].fill.start_color.rgb == 'FFFFFF00'
+
+    haem = wb['Haematology']
+    assert [c.value for c in haem[3]] == ['RCPA Term', 'LOINC', 'SNOMED_CT_Code', 'SNOMED_CT_Display']
+    assert haem['C1'].value is None and haem['C2'].value is None
+    assert [c.value for c in haem[4]][2:] == [168331010000106, 'Hemoglobin [Mass/volume] in Blood']
+    assert haem['C3'].font.bold
+    assert haem['A8'].fill.start_color.rgb == 'FFFFFF00'
+
+    # The formatted empty rows are not counted as unmapped data rows
+    assert 'MAPPED: 2' in caplog.text
+    assert 'UNMAPPED: 2' in caplog.text
+    assert 'TOTAL: 4' in caplog.text
@@ -0,0 +1,139 @@
+import os
+import json
+import atexit
+import hashlib
+import logging
+import threading
+import zipfile
+import requests
+from requests.structures import CaseInsensitiveDict
+
+logger = logging.getLogger(__name__)
+
+##
+## HTTP transport for terminology server requests.
+##
+## All /metadata, $expand and $lookup requests go through get() so that a run can be
+## recorded to, or replayed from, a compact indexed archive (a deflated zip file with one
+## entry per response body and an index.json mapping each URL to its entry, status and headers).
+## Replay needs no network, which makes mapper runs deterministic for testing and profiling.
+##
+## Mode is set with configure(), or from the TX_RECORD / TX_REPLAY environment variables
+## (path to the archive) for scripts such as test_map.py and test_ecl.py.
+##
+
+INDEX_NAME = 'index.json'
+
+_mode = None
+_archive = None
+_index = {}
+_lock = threading.Lock()
+_configured = False
+
+
+class ReplayMissError(LookupError):
+    """Raised in replay mode when a request was not captured in the archive."""
+
+
+class StoredResponse:
+    """
+    Minimal stand-in for requests.Response built from a stored (archived or cached) exchange.
+    """
+    def __init__(self, url, status_code, headers, content):
+        self.url = url
+        self.status_code = status_code
+        self.headers = CaseInsensitiveDict(headers)
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+    def json(self):
+        return json.loads(self.content)
+
+
+def _entry_name(url):
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+
+def configure(mode=None, archive_path=None):
+    """
+    Set the transport mode: None (live), 'record' or 'replay', with the archive path for the latter two.
+    """
+    global _mode, _archive, _index, _configured
+    close()
+    _configured = True
+    _mode = mode
+    if mode is None:
+        return
+    if mode == 'record':
+        _archive = zipfile.ZipFile(archive_path, 'w', compression=zipfile.ZIP_DEFLATED)
+        _index = {}
+        atexit.register(close)
+        logger.info(f"Recording terminology server exchanges to: {archive_path}")
+    elif mode == 'replay':
+        _archive = zipfile.ZipFile(archive_path, 'r')
+        _index = json.loads(_archive.read(INDEX_NAME))
+        logger.info(f"Replaying {len(_index)} terminology server exchanges from: {archive_path}")
+    else:
+        raise ValueError(f"Unknown transport mode: {mode}")
+
+
+def mode():
+    """
+    Return the current transport mode: None (live), 'record' or 'replay'.
+    """
+    if not _configured:
+        _configure_from_env()
+    return _mode
+
+
+def _configure_from_env():
+    if os.environ.get('TX_REPLAY'):
+        configure('replay', os.environ['TX_REPLAY'])
+    elif os.environ.get('TX_RECORD'):
+        configure('record', os.environ['TX_RECORD'])
+    else:
+        configure()
+
+
+def close():
+    """
+    Finish the archive. In record mode this writes the index; it is called automatically at exit.
+    """
+    global _archive, _mode
+    with _lock:
+        if _archive is None:
+            return
+        if _mode == 'record':
+            _archive.writestr(INDEX_NAME, json.dumps(_index, indent=1))
+        _archive.close()
+        _archive = None
+
+
+def get(url, headers=None):
+    """
+    GET a terminology server URL, recording or replaying the exchange according to the current mode.
+    """
+    if mode() == 'replay':
+        entry = _index.get(url)
+        if entry is None:
+            raise ReplayMissError(f"No recorded response for: {url}")
+        with _lock:
+            content = _archive.read(entry['entry'])
+        return StoredResponse(url, entry['status'], entry['headers'], content)
+
+    response = requests.get(url, headers=headers)
+
+    if _mode == 'record':
+        name = _entry_name(url)
+        with _lock:
+            if _archive is not None and url not in _index:
+                _archive.writestr(name, response.content)
+                _index[url] = {
+                    'entry': name,
+                    'status': response.status_code,
+                    'headers': dict(response.headers),
+                }
+    return response